@@ -1,25 +1,81 @@
 """Quarto Python filter that renders REPL-mode code chunks as interactive Python sessions."""
 
 import code
+import contextlib
+import functools
 import io
+import re
 import sys
 import token
 import tokenize
 
 import panflute as pf
+from pygments import format as format_tokens
 from pygments import highlight
 from pygments.formatters import HtmlFormatter
+from pygments.formatters.html import escape_html
 from pygments.lexers import Python3Lexer, PythonConsoleLexer
 from pygments.styles import get_style_by_name
-from pygments.token import Generic
+from pygments.token import Generic, Number, Operator, String
 
 REPR_SENTINEL = "\x00REPR\x00"
 CONTINUATION_KEYWORDS = frozenset({"else", "elif", "except", "finally", "case"})
 
+# Characters the triple-quote scanner stops at outside of strings, and inside
+# a single-line string opened with each quote character
+_SCAN_START_RE = re.compile(r"[\"'#]")
+_STRING_STOP_RE = {'"': re.compile(r'[\\"\n]'), "'": re.compile(r"[\\'\n]")}
 
-def _has_unterminated_triple_quote(source):
-    """Check if source has an odd number of triple-quote delimiters."""
-    return (source.count('"""') % 2 == 1) or (source.count("'''") % 2 == 1)
+# Each keyword followed by a character that can end it, for str.startswith
+_CONT_PREFIXES = tuple(
+    kw + sep for kw in CONTINUATION_KEYWORDS for sep in (" ", ":", "\t")
+)
+
+# Repr shapes that Python3Lexer always tokenizes the same way. Strings exclude
+# backslashes, % and braces, which the lexer splits into escape/interpolation tokens.
+_TRIVIAL_INT_RE = re.compile(r"-?[0-9]+")
+_TRIVIAL_FLOAT_RE = re.compile(r"-?[0-9]+\.[0-9]+")
+_TRIVIAL_STR_RE = re.compile(r"'[^'\\\n%{}]{0,64}'")
+
+
+@functools.lru_cache(maxsize=512)
+def _compile_outcome(source, symbol):
+    """Return the code object, None, or the raised SyntaxError for source."""
+    # Compiler warnings (e.g. invalid escape sequences) go to the real stderr,
+    # not into the capture sinks execute has installed for the transcript.
+    try:
+        with contextlib.redirect_stderr(sys.__stderr__):
+            return code.compile_command(source, symbol=symbol)
+    except SyntaxError as exc:
+        return exc
+
+
+def _compile_cached(source, symbol="single"):
+    """Memoized code.compile_command.
+
+    The incremental parse loop recompiles the same buffer prefixes repeatedly,
+    so outcomes are cached by (source, symbol). Cached SyntaxErrors are
+    re-raised so callers keep their ``except SyntaxError`` handling.
+    """
+    result = _compile_outcome(source, symbol)
+    if isinstance(result, SyntaxError):
+        raise result.with_traceback(None)
+    return result
+
+
+def _settle(source, outcome):
+    """Resolve the parse loop's compile outcome for the buffered source.
+
+    outcome is None (incomplete), a code object, "error", or "pending" when
+    lines were added without compiling. A pending outcome is compiled now;
+    the others are returned unchanged.
+    """
+    if outcome != "pending":
+        return outcome
+    try:
+        return _compile_cached(source, "single")
+    except SyntaxError:
+        return "error"
 
 
 def _has_unclosed_delimiters(source):
@@ -69,71 +125,225 @@ def _make_repl_style(base_name):
     return REPLStyle
 
 
+# Lexers hold no per-call state, so one instance serves every cell.
+_PY_LEXER = Python3Lexer()
+_CONSOLE_LEXER = PythonConsoleLexer()
+
+
+@functools.lru_cache(maxsize=16)
+def _get_formatters(style_name):
+    """Return (console_formatter, py_formatter) for style_name, built once per style."""
+    repl_style = _make_repl_style(style_name)
+    return (
+        HtmlFormatter(nowrap=True, noclasses=True, style=repl_style),
+        HtmlFormatter(nowrap=True, noclasses=True, style=style_name),
+    )
+
+
+@functools.lru_cache(maxsize=64)
+def _token_span(formatter, ttype):
+    """Return the (open, close) HTML that formatter wraps around a ttype token."""
+    html = format_tokens([(ttype, "\x00")], formatter).rstrip("\n")
+    open_tag, _, close_tag = html.partition("\x00")
+    return open_tag, close_tag
+
+
+def _wrap_token(formatter, ttype, escaped):
+    """Wrap already-escaped token text in the formatter's span for ttype."""
+    open_tag, close_tag = _token_span(formatter, ttype)
+    return open_tag + escaped + close_tag
+
+
+def _highlight_trivial_repr(text, formatter):
+    """Highlight an int, float, or simple str repr without running the lexer.
+
+    Produces the same HTML as highlight(text, _PY_LEXER, formatter) for these
+    shapes. Returns None when text needs a full Pygments pass.
+    """
+    if _TRIVIAL_STR_RE.fullmatch(text):
+        return _wrap_token(formatter, String.Single, escape_html(text))
+    if _TRIVIAL_INT_RE.fullmatch(text):
+        ttype = Number.Integer
+    elif _TRIVIAL_FLOAT_RE.fullmatch(text):
+        ttype = Number.Float
+    else:
+        return None
+
+    # A leading minus is a separate Operator token, which the formatter
+    # merges into the number's span when both have the same inline style.
+    merged = _token_span(formatter, Operator) == _token_span(formatter, ttype)
+    if text[0] != "-" or merged:
+        return _wrap_token(formatter, ttype, text)
+    minus = _wrap_token(formatter, Operator, "-")
+    return minus + _wrap_token(formatter, ttype, text[1:])
+
+
+def _highlight_reprs(texts, formatter):
+    """Highlight each repr text, returning the HTML for each in order.
+
+    Trivial reprs skip the lexer entirely. The rest are lexed one by one, so
+    lexer state can't leak from one repr into the next, and then formatted in
+    a single pass that is split back into per-repr HTML.
+    """
+    html = [_highlight_trivial_repr(text, formatter) for text in texts]
+    pending = [i for i, h in enumerate(html) if h is None]
+    if not pending:
+        return html
+
+    tokens = []
+    line_counts = []
+    for i in pending:
+        repr_tokens = list(_PY_LEXER.get_tokens(texts[i]))
+        line_counts.append(sum(value.count("\n") for _, value in repr_tokens))
+        tokens.extend(repr_tokens)
+
+    formatted = format_tokens(tokens, formatter).split("\n")
+    start = 0
+    for i, count in zip(pending, line_counts):
+        html[i] = "\n".join(formatted[start : start + count])
+        start += count
+    return html
+
+
+class _CaptureIO(io.StringIO):
+    """StringIO that can be read and emptied in one step."""
+
+    def drain(self):
+        """Return everything written so far and empty the buffer."""
+        value = self.getvalue()
+        self.seek(0)
+        self.truncate()
+        return value
+
+
 class REPLSession:
     """Persistent REPL session that maintains state across chunks in a document."""
 
     def __init__(self):
         self.console = code.InteractiveConsole()
+        # Incremental triple-quote scan state for the current buffer:
+        # (inside """ string, inside ''' string) and how far it has been scanned.
+        self._in_triple = (False, False)
+        self._scan_cursor = 0
+        # Capture sinks, installed once per execute call and drained after
+        # each statement runs.
+        self._out = _CaptureIO()
+        self._err = _CaptureIO()
+        self._repr_values: list[str] = []
+
+    def _reset_triple_scan(self):
+        """Forget the triple-quote scan state before a new buffer is started."""
+        self._in_triple = (False, False)
+        self._scan_cursor = 0
+
+    def _has_unterminated_triple_quote(self, source):
+        """Check if source ends inside a triple-quoted string.
+
+        Only the text appended since the previous call is scanned, so source
+        must extend the previously scanned buffer until _reset_triple_scan is
+        called. Quotes inside comments and single-line strings are ignored,
+        and backslash escapes are skipped.
+        """
+        in_double, in_single = self._in_triple
+        i = self._scan_cursor
+        n = len(source)
+        # Jump between delimiters with str.find / regex search rather than
+        # stepping through every character.
+        while i < n:
+            if in_double or in_single:
+                j = source.find('"""' if in_double else "'''", i)
+                if j == -1:
+                    i = n
+                    break
+                # An odd run of backslashes escapes the first quote
+                k = j
+                while k > i and source[k - 1] == "\\":
+                    k -= 1
+                if (j - k) % 2:
+                    i = j + 1
+                    continue
+                in_double = in_single = False
+                i = j + 3
+                continue
 
-    def _flush_buffer(self, buffer, output_parts):
-        """Compile and execute the accumulated buffer, appending results to output_parts."""
-        full = "\n".join(buffer)
-
-        try:
-            # Try with trailing \n to signal end-of-block to compile_command
-            compiled = code.compile_command(full + "\n", symbol="single")
-        except SyntaxError:
-            compiled = None
-            # Show the lines and the syntax error
-            output_parts.append(f">>> {buffer[0]}")
-            for b in buffer[1:]:
-                output_parts.append(f"... {b}")
-            old_stderr = sys.stderr
-            sys.stderr = captured_err = io.StringIO()
-            self.console.showsyntaxerror()
-            sys.stderr = old_stderr
-            err = captured_err.getvalue()
-            if err:
-                output_parts.append(err.rstrip())
-            return
+            m = _SCAN_START_RE.search(source, i)
+            if m is None:
+                i = n
+                break
+            j = m.start()
+            ch = source[j]
+            if ch == "#":
+                i = source.find("\n", j)
+                if i == -1:
+                    i = n
+            elif source.startswith(ch * 3, j):
+                in_double, in_single = ch == '"', ch == "'"
+                i = j + 3
+            else:
+                # Single-line string: ends at its quote or the end of the line
+                stop_re = _STRING_STOP_RE[ch]
+                i = j + 1
+                while True:
+                    m = stop_re.search(source, i)
+                    if m is None:
+                        i = n
+                        break
+                    if source[m.start()] != "\\":
+                        i = m.end()
+                        break
+                    i = m.start() + 2
+
+        # Lines are always appended whole, so an open single-line string
+        # can't carry over to the next call.
+        self._in_triple = (in_double, in_single)
+        self._scan_cursor = i
+        return in_double or in_single
+
+    def _displayhook(self, value):
+        """sys.displayhook replacement that records reprs for the transcript."""
+        if value is not None:
+            self._repr_values.append(repr(value))
+            builtins = self.console.locals.setdefault("__builtins__", {})
+            if isinstance(builtins, dict):
+                builtins["_"] = value
+            else:
+                setattr(builtins, "_", value)
+
+    def _flush_buffer(self, buffer, output_parts, compiled=None):
+        """Compile and execute the accumulated buffer, appending results to output_parts.
+
+        If the caller already holds the buffer's code object, pass it as
+        compiled to skip recompiling. None or "error" recompiles the buffer
+        with a trailing newline, showing the syntax error if there is one.
+        """
+        # Prompted source lines come first on every path, as one joined block
+        output_parts.append(
+            "\n".join([">>> " + buffer[0], *["... " + b for b in buffer[1:]]])
+        )
+
+        if compiled is None or compiled == "error":
+            try:
+                # Try with trailing \n to signal end-of-block to compile_command
+                compiled = _compile_cached("\n".join(buffer) + "\n", "single")
+            except SyntaxError:
+                # Show the syntax error after the lines
+                self.console.showsyntaxerror()
+                err = self._err.drain()
+                if err:
+                    output_parts.append(err.rstrip())
+                return
 
         if compiled is None:
             # Still incomplete even with trailing newline — shouldn't happen in flush,
             # but handle gracefully by just showing the lines
-            output_parts.append(f">>> {buffer[0]}")
-            for b in buffer[1:]:
-                output_parts.append(f"... {b}")
             return
 
-        output_parts.append(f">>> {buffer[0]}")
-        for b in buffer[1:]:
-            output_parts.append(f"... {b}")
-
-        old_stdout = sys.stdout
-        old_stderr = sys.stderr
-        old_displayhook = sys.displayhook
-        sys.stdout = captured_out = io.StringIO()
-        sys.stderr = captured_err = io.StringIO()
-
-        repr_values = []
-
-        def _capture_displayhook(value):
-            if value is not None:
-                repr_values.append(repr(value))
-                builtins = self.console.locals.setdefault("__builtins__", {})
-                if isinstance(builtins, dict):
-                    builtins["_"] = value
-                else:
-                    setattr(builtins, "_", value)
-
-        sys.displayhook = _capture_displayhook
         self.console.runcode(compiled)
 
-        stdout_val = captured_out.getvalue()
-        stderr_val = captured_err.getvalue()
-        sys.stdout = old_stdout
-        sys.stderr = old_stderr
-        sys.displayhook = old_displayhook
+        stdout_val = self._out.drain()
+        stderr_val = self._err.drain()
+        repr_values = self._repr_values
+        self._repr_values = []
 
         if stdout_val:
             output_parts.append(stdout_val.rstrip())
@@ -145,53 +355,112 @@ class REPLSession:
     @staticmethod
     def _next_line_is_continuation(lines, i):
         """Check if the line after index i starts with a continuation keyword."""
-        if i + 1 >= len(lines):
-            return False
-        next_stripped = lines[i + 1].lstrip()
-        if not next_stripped:
-            return False
-        next_keyword = next_stripped.split()[0].rstrip(":")
-        return next_keyword in CONTINUATION_KEYWORDS
+        return i + 1 < len(lines) and REPLSession._is_continuation_keyword(lines[i + 1])
 
     @staticmethod
     def _is_continuation_keyword(line):
         """Check if a line starts with a continuation keyword."""
         stripped = line.lstrip()
-        if not stripped:
-            return False
-        keyword = stripped.split()[0].rstrip(":")
-        return keyword in CONTINUATION_KEYWORDS
+        return stripped.startswith(_CONT_PREFIXES) or stripped in CONTINUATION_KEYWORDS
 
     def execute(self, source: str) -> str:
         """Execute source code line-by-line and return REPL-formatted output."""
-        lines = source.strip().split("\n")
+        # Install the capture hooks once for the whole cell rather than
+        # around each statement; _flush_buffer drains them per statement.
+        self._out.drain()
+        self._err.drain()
+        self._repr_values = []
+        old_displayhook = sys.displayhook
+        sys.displayhook = self._displayhook
+        try:
+            with (
+                contextlib.redirect_stdout(self._out),
+                contextlib.redirect_stderr(self._err),
+            ):
+                return self._execute(source)
+        finally:
+            sys.displayhook = old_displayhook
+
+    def _execute(self, source):
+        """Run source against the console and build its REPL transcript.
+
+        Expects the capture hooks installed by execute to be in place.
+        """
+        # Trim surrounding blank lines without copying the whole source first.
+        # Split on "\n" only: str.splitlines also breaks on characters such as
+        # U+2028 and \x0c, which are valid inside string literals.
+        lines = source.replace("\r\n", "\n").split("\n")
+        start, end = 0, len(lines)
+        while start < end and not lines[start].strip():
+            start += 1
+        while end > start and not lines[end - 1].strip():
+            end -= 1
+        if start == end:
+            return ""
+        lines = lines[start:end]
         output_parts = []
         buffer = []
+        full = ""
+        # Outcome of compiling the current buffer: None (incomplete), a code
+        # object, "error", or "pending" if lines were added without compiling.
+        last_compiled = None
 
         for i, line in enumerate(lines):
-            # If buffer has an incomplete block and the new line is unindented
+            # If the buffer holds a block and the new line is unindented
             # (starts a new statement), flush the buffer first.
             # Skip this check for continuation keywords (else, elif, except, etc.)
             if buffer and not line.startswith((" ", "\t")) and line.strip():
-                if not self._is_continuation_keyword(line):
-                    full = "\n".join(buffer)
-                    try:
-                        compiled = code.compile_command(full, symbol="single")
-                    except SyntaxError:
-                        compiled = "error"
-                    if compiled is None and not _has_unterminated_triple_quote(full) and not _has_unclosed_delimiters(full):
-                        # Buffer is incomplete — flush it before starting the new line
-                        self._flush_buffer(buffer, output_parts)
+                if not (
+                    self._is_continuation_keyword(line)
+                    or self._has_unterminated_triple_quote(full)
+                ):
+                    # If indented lines were skipped since the last compile,
+                    # the buffer may be complete (closing bracket on an
+                    # indented line) or invalid, not just an incomplete block.
+                    last_compiled = _settle(full, last_compiled)
+                    if last_compiled is not None or not _has_unclosed_delimiters(full):
+                        self._flush_buffer(buffer, output_parts, last_compiled)
                         buffer = []
 
+            # A statement can also end on a skipped indented line (closing """
+            # or bracket). Settle that before a blank or comment-only line
+            # would be absorbed into its buffer.
+            if (
+                last_compiled == "pending"
+                and buffer
+                and (not line.strip() or line.lstrip().startswith("#"))
+                and not self._has_unterminated_triple_quote(full)
+            ):
+                last_compiled = _settle(full, last_compiled)
+                if last_compiled is not None:
+                    self._flush_buffer(buffer, output_parts, last_compiled)
+                    buffer = []
+
+            # Extend the joined buffer incrementally rather than re-joining
+            # every line on each iteration.
+            if buffer:
+                full = full + "\n" + line
+            else:
+                full = line
+                self._reset_triple_scan()
             buffer.append(line)
-            full = "\n".join(buffer)
+
+            # Indented lines and lines inside a triple-quoted string can't end
+            # the buffered statement, so defer compiling to the next unindented
+            # line (or the final flush).
+            if len(buffer) > 1 and (
+                line.startswith((" ", "\t"))
+                or self._has_unterminated_triple_quote(full)
+            ):
+                last_compiled = "pending"
+                continue
 
             try:
-                compiled = code.compile_command(full, symbol="single")
+                compiled = last_compiled = _compile_cached(full, "single")
             except SyntaxError:
+                last_compiled = "error"
                 # Check if this might be an unterminated triple-quoted string
-                if _has_unterminated_triple_quote(full):
+                if self._has_unterminated_triple_quote(full):
                     continue
                 # Syntax error — flush buffer with error
                 self._flush_buffer(buffer, output_parts)
@@ -206,7 +475,7 @@ class REPLSession:
             if self._next_line_is_continuation(lines, i):
                 continue
 
-            self._flush_buffer(buffer, output_parts)
+            self._flush_buffer(buffer, output_parts, compiled)
             buffer = []
 
         # Flush any remaining buffer (e.g., trailing block statement)
@@ -218,6 +487,11 @@ class REPLSession:
 
 session = REPLSession()
 
+# Highlighted HTML keyed by (style name, REPL transcript). Keying on the
+# transcript rather than the cell source means execution still always runs
+# against the live session; only the Pygments pass is skipped for repeats.
+_HTML_CACHE: dict[tuple[str, str], str] = {}
+
 
 def handle_cell(elem, doc):
     if not isinstance(elem, pf.Div):
@@ -253,16 +527,28 @@ def handle_cell(elem, doc):
         hl = doc.get_metadata("repl-highlight-style", None)
         if hl and isinstance(hl, str):
             pygments_style = hl
-    repl_style = _make_repl_style(pygments_style)
-    formatter = HtmlFormatter(nowrap=True, noclasses=True, style=repl_style)
-    py_formatter = HtmlFormatter(nowrap=True, noclasses=True, style=pygments_style)
-    py_lexer = Python3Lexer()
+
+    key = (pygments_style, result)
+    cached = _HTML_CACHE.get(key)
+    if cached is not None:
+        return pf.RawBlock(cached, format="html")
+
+    formatter, py_formatter = _get_formatters(pygments_style)
 
     # Highlight contiguous console lines (>>> and ...) as a block so
     # PythonConsoleLexer can properly parse continuation lines.
-    # Repr output lines get individual Python syntax highlighting.
-    console_lexer = PythonConsoleLexer()
+    # Repr output lines get Python syntax highlighting, all in one pass.
     lines = result.split("\n")
+    repr_html = iter(
+        _highlight_reprs(
+            [
+                line[len(REPR_SENTINEL) :]
+                for line in lines
+                if line.startswith(REPR_SENTINEL)
+            ],
+            py_formatter,
+        )
+    )
     highlighted_parts = []
     console_buf = []
 
@@ -270,28 +556,62 @@ def handle_cell(elem, doc):
         if console_buf:
             block = "\n".join(console_buf)
             highlighted_parts.append(
-                highlight(block, console_lexer, formatter).rstrip("\n")
+                highlight(block, _CONSOLE_LEXER, formatter).rstrip("\n")
             )
             console_buf.clear()
 
     for line in lines:
         if line.startswith(REPR_SENTINEL):
             flush_console()
-            repr_text = line[len(REPR_SENTINEL) :]
-            highlighted_parts.append(
-                highlight(repr_text, py_lexer, py_formatter).rstrip("\n")
-            )
+            highlighted_parts.append(next(repr_html))
         else:
             console_buf.append(line)
 
     flush_console()
-    highlighted = "\n".join(highlighted_parts)
-    html = f'<div class="sourceCode"><pre class="sourceCode pycon"><code class="sourceCode pycon">{highlighted}</code></pre></div>'
+    # Join the wrapper and the newline-separated parts in a single pass
+    pieces = [
+        '<div class="sourceCode"><pre class="sourceCode pycon"><code class="sourceCode pycon">'
+    ]
+    for i, part in enumerate(highlighted_parts):
+        if i:
+            pieces.append("\n")
+        pieces.append(part)
+    pieces.append("</code></pre></div>")
+    html = "".join(pieces)
+    _HTML_CACHE[key] = html
     return pf.RawBlock(html, format="html")
 
 
+# Elements whose subtrees can't hold a REPL cell: code and raw blocks and the
+# metadata tree. Cells are block-level Divs, so the walk doesn't descend into
+# these.
+_NO_CELL_DESCENDANTS = (pf.CodeBlock, pf.RawBlock, pf.MetaMap)
+
+# Blocks that hold only inlines. A footnote (pf.Note) is the one inline that
+# carries block content, so these are skipped only when they hold no Note.
+_INLINE_BLOCKS = (pf.Para, pf.Plain, pf.Header, pf.LineBlock)
+
+
+def _contains_note(elem):
+    """Check if any element below elem is a footnote."""
+    for name in elem._children:
+        child = getattr(elem, name)
+        if child is None:
+            continue
+        for item in child if isinstance(child, pf.ListContainer) else (child,):
+            if isinstance(item, pf.Note) or _contains_note(item):
+                return True
+    return False
+
+
+def _cannot_contain_cells(elem):
+    if isinstance(elem, _NO_CELL_DESCENDANTS):
+        return True
+    return isinstance(elem, _INLINE_BLOCKS) and not _contains_note(elem)
+
+
 def main(doc=None):
-    return pf.run_filter(handle_cell, doc=doc)
+    return pf.run_filter(handle_cell, doc=doc, stop_if=_cannot_contain_cells)
 
 
 if __name__ == "__main__":
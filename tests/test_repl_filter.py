@@ -1,14 +1,25 @@
 """Tests for repl_filter.py"""
 
 import sys
+import warnings
 from pathlib import Path
 
 # Add the extension directory to sys.path so we can import the filter
 sys.path.insert(0, str(Path(__file__).parent.parent / "_extensions" / "repl-mode"))
 
+import panflute as pf
 from pygments.token import Generic
 
-from repl_filter import REPR_SENTINEL, REPLSession, _make_repl_style
+from repl_filter import (
+    _PY_LEXER,
+    REPR_SENTINEL,
+    REPLSession,
+    _get_formatters,
+    _highlight_reprs,
+    _highlight_trivial_repr,
+    _make_repl_style,
+    main,
+)
 
 
 S = REPR_SENTINEL
@@ -30,6 +41,21 @@ class TestSimpleStatements:
         result = self.session.execute("2 + 3")
         assert result == f">>> 2 + 3\n{S}5"
 
+    def test_surrounding_blank_lines_trimmed(self):
+        result = self.session.execute("\n  \nx = 1\nx\n\n   \n")
+        assert result == f">>> x = 1\n>>> x\n{S}1"
+
+    def test_windows_line_endings(self):
+        result = self.session.execute("x = 1\r\nx\r\n")
+        assert result == f">>> x = 1\n>>> x\n{S}1"
+
+    def test_line_separator_inside_string_literal(self):
+        result = self.session.execute('s = "a\u2028b"\ns')
+        assert result == f">>> s = \"a\u2028b\"\n>>> s\n{S}'a\\u2028b'"
+
+    def test_empty_source(self):
+        assert self.session.execute("\n   \n") == ""
+
     def test_multiple_expressions(self):
         result = self.session.execute("x = 10\nx\nx * 2")
         lines = result.split("\n")
@@ -53,6 +79,14 @@ class TestPrintVsRepr:
         result = self.session.execute("'hello'")
         assert result == f">>> 'hello'\n{S}'hello'"
 
+    def test_print_to_captured_stream_methods(self):
+        result = self.session.execute(
+            "import sys\nsys.stdout.isatty()\nprint('hi', flush=True)"
+        )
+        assert f"{S}False" in result
+        assert "hi" in result
+        assert "Error" not in result
+
     def test_print_and_repr_separated(self):
         """A function that prints and returns should show print first, repr second."""
         code = "def f():\n    print('side effect')\n    return 42\nf()"
@@ -135,6 +169,10 @@ class TestMultiLineBlocks:
         assert "done" in result
         assert "SyntaxError" not in result
 
+    def test_inline_finally_body(self):
+        result = self.session.execute("try:\n    x = 1\nfinally:print('done')")
+        assert result == ">>> try:\n...     x = 1\n... finally:print('done')\ndone"
+
     def test_for_else(self):
         result = self.session.execute(
             "for i in []:\n    pass\nelse:\n    print('empty')"
@@ -165,6 +203,20 @@ class TestMultiLineBlocks:
         assert "hello" in repr_lines[0]
         assert "world" in repr_lines[0]
 
+    def test_blank_line_after_indented_closing_triple_quote(self):
+        result = self.session.execute('x = """\n    hello\n    """\n\ny = 2\ny')
+        assert result.startswith('>>> x = """\n...     hello\n...     """\n>>> \n>>> y')
+
+    def test_triple_quote_in_comment_ignored(self):
+        result = self.session.execute('if True:\n    y = 1  # """\ny')
+        assert "SyntaxError" not in result
+        assert f">>> y\n{S}1" in result
+
+    def test_triple_quote_in_string_ignored(self):
+        result = self.session.execute('if True:\n    q = \'"""\'\nq')
+        assert "SyntaxError" not in result
+        assert f'{S}\'"""\'' in result
+
     def test_function_def_and_call(self):
         result = self.session.execute(
             "def greet(name):\n    return f'hi {name}'\ngreet('world')"
@@ -181,6 +233,11 @@ class TestStatePersistence:
         result = self.session.execute("x")
         assert f"{S}99" in result
 
+    def test_repeated_cell_reruns_after_state_change(self):
+        self.session.execute("n = 0")
+        assert self.session.execute("n += 1\nn").endswith(f"{S}1")
+        assert self.session.execute("n += 1\nn").endswith(f"{S}2")
+
     def test_import_persists(self):
         self.session.execute("import math")
         result = self.session.execute("math.pi")
@@ -208,6 +265,45 @@ class TestErrorHandling:
         result = self.session.execute("x = 1\nx")
         assert f"{S}1" in result
 
+    def test_syntax_error_in_indented_body(self):
+        """An error inside a block should not swallow the following statement."""
+        result = self.session.execute("def f():\n    return )\nx = 1\nx")
+        assert "SyntaxError" in result
+        assert f">>> x = 1\n>>> x\n{S}1" in result
+
+    def test_compiler_warning_not_in_transcript(self, monkeypatch):
+        """Compiler warnings go to the real stderr, not into the cell output."""
+
+        def show(message, category, filename, lineno, file=None, line=None):
+            sys.stderr.write(
+                warnings.formatwarning(message, category, filename, lineno, line)
+            )
+
+        # pytest records warnings; print them to sys.stderr like the default
+        monkeypatch.setattr(warnings, "showwarning", show)
+        with warnings.catch_warnings():
+            warnings.simplefilter("always")
+            result = self.session.execute("w = 1\nw is 1")
+        assert result == f">>> w = 1\n>>> w is 1\n{S}True"
+
+    def test_system_exit_restores_streams(self):
+        """runcode re-raises SystemExit; the capture hooks must still be removed."""
+        stdout, stderr, displayhook = sys.stdout, sys.stderr, sys.displayhook
+        try:
+            self.session.execute("raise SystemExit")
+        except SystemExit:
+            pass
+        assert sys.stdout is stdout
+        assert sys.stderr is stderr
+        assert sys.displayhook is displayhook
+
+    def test_repeated_syntax_error_uses_cache(self):
+        """A cached SyntaxError should still be reported on every occurrence."""
+        first = self.session.execute("def")
+        second = self.session.execute("def")
+        assert "SyntaxError" in first
+        assert first == second
+
 
 class TestHighlighting:
     def test_make_repl_style_overrides_output_color(self):
@@ -244,6 +340,37 @@ class TestHighlighting:
                 "Could not find '... else' continuation line in output"
             )
 
+    def test_formatters_are_cached_per_style(self):
+        assert _get_formatters("monokai") is _get_formatters("monokai")
+        assert _get_formatters("monokai") is not _get_formatters("default")
+
+    def test_trivial_repr_matches_pygments(self):
+        """The repr fast path should produce exactly what Pygments would."""
+        from pygments import highlight
+
+        samples = ["0", "42", "-42", "3.25", "-0.5", "''", "'abc'", "'<&>'", "'\"'"]
+        for style in ["default", "monokai"]:
+            _, py_formatter = _get_formatters(style)
+            for text in samples:
+                expected = highlight(text, _PY_LEXER, py_formatter).rstrip("\n")
+                assert _highlight_trivial_repr(text, py_formatter) == expected
+
+    def test_non_trivial_repr_not_fast_pathed(self):
+        _, py_formatter = _get_formatters("default")
+        for text in ["1e+20", "'a%s'", "'{x}'", "'a\\nb'", "[1, 2]", "None"]:
+            assert _highlight_trivial_repr(text, py_formatter) is None
+
+    def test_batched_reprs_match_individual_highlighting(self):
+        """Lexer state from one repr (e.g. a trailing `class`) must not leak into the next."""
+        from pygments import highlight
+
+        texts = ["[1, 2]", "class", "x", "<A '''>", "None", "42", "", "{'a': 1}"]
+        _, py_formatter = _get_formatters("monokai")
+        expected = [
+            highlight(text, _PY_LEXER, py_formatter).rstrip("\n") for text in texts
+        ]
+        assert _highlight_reprs(texts, py_formatter) == expected
+
     def test_make_repl_style_preserves_other_tokens(self):
         from pygments.styles import get_style_by_name
 
@@ -293,6 +420,12 @@ class TestParenthesesStatements:
         assert "world" in result
         assert "SyntaxError" not in result
 
+    def test_indented_closing_bracket(self):
+        """A closing bracket on an indented line should still end the statement."""
+        code = "x = (\n    1\n    )\nx"
+        result = self.session.execute(code)
+        assert result == f">>> x = (\n...     1\n...     )\n>>> x\n{S}1"
+
     def test_nested_delimiters(self):
         """Nested parentheses/brackets/braces should work."""
         code = "result = [(1, 2), (3, 4)]\nresult"
@@ -306,3 +439,37 @@ class TestParenthesesStatements:
         result = self.session.execute(code)
         assert "SyntaxError" not in result
         assert S in result
+
+
+class TestFilter:
+    @staticmethod
+    def _cell(source):
+        return pf.Div(
+            pf.CodeBlock(source, classes=["python", "cell-code"]),
+            classes=["cell"],
+            attributes={"repl-mode": "true"},
+        )
+
+    def test_main_renders_nested_cells_only(self):
+        """Cells inside other Divs are found; paragraphs and plain cells are kept."""
+        plain_cell = pf.Div(
+            pf.CodeBlock("y = 2", classes=["python", "cell-code"]), classes=["cell"]
+        )
+        doc = pf.Doc(
+            pf.Para(pf.Str("intro")),
+            pf.Div(self._cell("1 + 1"), classes=["callout"]),
+            plain_cell,
+        )
+        doc = main(doc)
+        para, callout, plain = doc.content
+        assert isinstance(para, pf.Para)
+        raw = callout.content[0]
+        assert isinstance(raw, pf.RawBlock)
+        assert "pycon" in raw.text
+        assert isinstance(plain, pf.Div)
+
+    def test_main_renders_cell_inside_footnote(self):
+        doc = pf.Doc(pf.Para(pf.Str("see"), pf.Note(self._cell("1 + 1"))))
+        doc = main(doc)
+        note = doc.content[0].content[1]
+        assert isinstance(note.content[0], pf.RawBlock)